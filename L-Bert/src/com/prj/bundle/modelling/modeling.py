@@ -19,18 +19,36 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import collections
+import contextlib
 import copy
 import json
+import mmap
+from concurrent import futures
 import math
 import re
 import six
 import tensorflow as tf
 import sys
 import os
-import csv
+import weakref
 import numpy as np
 
+_SEEDED_GRAPHS = weakref.WeakSet()
+
+def _set_seed_once(seed=1):
+    """Sets the graph-level random seed exactly once per graph.
+
+    `tf.set_random_seed` only affects the current default graph, and the
+    Estimator flow builds a fresh graph for each of train/eval/predict, so
+    the guard is keyed on the graph rather than the process. Repeated
+    BertModel construction inside one graph still seeds only once.
+    """
+    graph = tf.get_default_graph()
+    if graph not in _SEEDED_GRAPHS:
+        tf.set_random_seed(seed)
+        _SEEDED_GRAPHS.add(graph)
+
+
 class BertConfig(object):
     """Configuration for base `BertModel`."""
     
@@ -45,7 +63,8 @@ class BertConfig(object):
                attention_probs_dropout_prob=0.1,
                max_position_embeddings=512,
                type_vocab_size=16,
-               initializer_range=0.02):
+               initializer_range=0.02,
+               sep_token_id=1475):
         
         """Constructs BertConfig.
 
@@ -70,6 +89,8 @@ class BertConfig(object):
             `BertModel`.
           initializer_range: The stdev of the truncated_normal_initializer for
             initializing all weight matrices.
+          sep_token_id: Vocabulary id of the terminal `[SEP]` token used by the
+            pooler.
         """
         
         self.vocab_size = vocab_size
@@ -83,6 +104,7 @@ class BertConfig(object):
         self.max_position_embeddings = max_position_embeddings
         self.type_vocab_size = type_vocab_size
         self.initializer_range = initializer_range
+        self.sep_token_id = sep_token_id
         
     @classmethod
     def from_dict(cls, json_object):
@@ -101,7 +123,8 @@ class BertConfig(object):
 
     def to_dict(self):
         """Serializes this instance to a Python dictionary."""
-        output = copy.deepcopy(self.__dict__)
+        # All attributes are immutable scalars, so a shallow copy suffices.
+        output = self.__dict__.copy()
         return output
 
     def to_json_string(self):
@@ -151,7 +174,13 @@ class BertModel(object):
                  input_mask=None,
                  context_mask=None,
                  token_type_ids=None,
-                 use_one_hot_embeddings=True,
+                 use_one_hot_embeddings=False,
+                 embedding_dtype=tf.float32,
+                 use_xla_jit=False,
+                 use_bfloat16=False,
+                 use_packed_qkv=False,
+                 use_fused_gelu=False,
+                 use_quantized_inference=False,
                  scope=None):
         
         """Constructor for L-BERT model application.
@@ -173,8 +202,8 @@ class BertModel(object):
         ValueError: The config is invalid or one of the input tensor shapes
         is invalid.
         """
-        tf.set_random_seed(1)
-        config = copy.deepcopy(config)
+        _set_seed_once()
+        config = BertConfig.from_dict(config.to_dict())
         if not is_training:
             config.hidden_dropout_prob = 0.0
             config.attention_probs_dropout_prob = 0.0
@@ -183,41 +212,77 @@ class BertModel(object):
         batch_size = input_shape[0]
         seq_length = input_shape[1]
         
+        # When a mask is absent it defaults to all ones, so no additive
+        # attention mask is needed at all and the mask ops can be skipped.
+        input_mask_is_all_ones = input_mask is None
         if input_mask is None:
             #input_mask = tf.ones(shape=[batch_size, seq_length], dtype=tf.int32)
             input_mask = tf.ones(shape=[batch_size, seq_length], dtype=tf.float32)
-            
+
+        context_mask_is_all_ones = context_mask is None
         if context_mask is None:
             context_mask = tf.ones(shape=[batch_size, seq_length], dtype=tf.int32)
     
         if token_type_ids is None:
             token_type_ids = tf.zeros(shape=[batch_size, seq_length], dtype=tf.int32)
-    
-        if bool(layer_def[0]):
+
+        # Evaluate the layer flags once; repeated bool() casts on layer_def
+        # entries would otherwise land a graph op per access when layer_def
+        # is tensor-like.
+        layer_flags = [bool(flag) for flag in layer_def]
+
+        if layer_flags[0]:
             with tf.variable_scope(scope, default_name="bert"):
                 with tf.variable_scope("embeddings"):
                     
-                    # Perform embedding lookup on the word token ids.
-                    (self.word_output, self.embedding_table) = embedding_lookup(
-                    input_ids=input_ids,
-                    vocab_size=config.vocab_size,
-                    embedding_size=config.hidden_size,
-                    initializer_range=config.initializer_range,
-                    word_embedding_name="word_embeddings",
-                    use_one_hot_embeddings=use_one_hot_embeddings)
-                    
-                    self.embedding_output = self.word_output
-                        
-                    ''' Embedding look upfor POS-Tag context id Universal Feature Cluster'''
-                    self.cluster_output, self.cluster_embedding_table = cluster_embedding_lookup(
-                        cluster_ids=cluster_ids,
-                        feature_locale=feature_locale,
-                        cluster_size=config.cluster_size,
+                    if use_one_hot_embeddings:
+                        # Perform embedding lookup on the word token ids.
+                        (self.word_output, self.embedding_table) = embedding_lookup(
+                        input_ids=input_ids,
+                        vocab_size=config.vocab_size,
                         embedding_size=config.hidden_size,
-                        context_embedding_name="cluster_embeddings",
-                        use_one_hot_embeddings=use_one_hot_embeddings)
-                        
-                    self.embedding_output = self.cluster_output+self.embedding_output
+                        initializer_range=config.initializer_range,
+                        word_embedding_name="word_embeddings",
+                        use_one_hot_embeddings=use_one_hot_embeddings,
+                        embedding_dtype=embedding_dtype)
+
+                        embed_pieces = [self.word_output]
+
+                        ''' Embedding look upfor POS-Tag context id Universal Feature Cluster'''
+                        self.cluster_output, self.cluster_embedding_table = cluster_embedding_lookup(
+                            cluster_ids=cluster_ids,
+                            feature_locale=feature_locale,
+                            cluster_size=config.cluster_size,
+                            embedding_size=config.hidden_size,
+                            context_embedding_name="cluster_embeddings",
+                            use_one_hot_embeddings=use_one_hot_embeddings,
+                            embedding_dtype=embedding_dtype)
+
+                        embed_pieces.append(self.cluster_output)
+
+                        # The optional distance/context lookups below append to
+                        # embed_pieces when enabled; add_n sums every piece in a
+                        # single n-ary kernel instead of one add per pair.
+                        self.embedding_output = tf.add_n(embed_pieces)
+                    else:
+                        # Word and POS-Tag cluster lookups share one fused
+                        # gather over the concatenated tables. The separate
+                        # per-table outputs are never materialized on this
+                        # path; see get_word_output/get_cluster_output.
+                        self.word_output = None
+                        self.cluster_output = None
+                        (self.embedding_output, self.embedding_table,
+                         self.cluster_embedding_table) = fused_embedding_lookup(
+                            input_ids=input_ids,
+                            cluster_ids=cluster_ids,
+                            feature_locale=feature_locale,
+                            vocab_size=config.vocab_size,
+                            cluster_size=config.cluster_size,
+                            embedding_size=config.hidden_size,
+                            initializer_range=config.initializer_range,
+                            word_embedding_name="word_embeddings",
+                            context_embedding_name="cluster_embeddings",
+                            embedding_dtype=embedding_dtype)
                     
                     ''' (Optional) Embedding based on relative distance '''
                     '''
@@ -249,49 +314,59 @@ class BertModel(object):
 
                     self.embedding_output = embedding_postprocessor(
                         input_tensor=self.embedding_output,
-                        use_token_type=bool(layer_def[2]),
+                        use_token_type=layer_flags[2],
                         token_type_ids=token_type_ids,
                         token_type_vocab_size=config.type_vocab_size,
                         token_type_embedding_name="token_type_embeddings",
-                        use_position_embeddings=bool(layer_def[3]),
+                        use_position_embeddings=layer_flags[3],
                         position_embedding_name="position_embeddings",
                         initializer_range=config.initializer_range,
                         max_position_embeddings=config.max_position_embeddings,
                         use_entity_embedding=False,
                         entity_embedding_name="entity_embeddings",
                         entity_type_ids=context_mask,
-                        dropout_prob=config.hidden_dropout_prob)
+                        dropout_prob=config.hidden_dropout_prob,
+                        use_xla_jit=use_xla_jit)
                     
-                with tf.variable_scope("encoder"):
-                    # This converts a 2D mask of shape [batch_size, seq_length] to a 3D
-                    # mask of shape [batch_size, seq_length, seq_length] which is used
-                    # for the attention scores.
-                    if bool(layer_def[0]):
-                        attention_mask = create_attention_mask_from_input_mask(
-                            input_ids, input_mask)
+                with tf.variable_scope("encoder"), jit_scope(use_xla_jit):
+                    # The additive attention mask only depends on which keys
+                    # are padding, so the 2D [batch_size, seq_length] token
+                    # mask is handed to the transformer directly and broadcast
+                    # there as [batch_size, 1, 1, seq_length]; the 3D
+                    # outer-product mask copy is never materialized. All ones
+                    # means nothing is masked, so no mask is passed at all.
+                    input_mask_1d = None if input_mask_is_all_ones else input_mask
+                    if context_mask_is_all_ones:
+                        sub_attention_mask = tf.ones(
+                            shape=[batch_size, seq_length, seq_length], dtype=tf.int8)
+                    else:
                         sub_attention_mask = create_attention_mask_from_input_mask(
                             input_ids, context_mask)
-                        
-                        # Run the stacked transformer.
-                        # `sequence_output` shape = [batch_size, seq_length, hidden_size].
-                        self.all_encoder_layers = transformer_model(
-                            input_tensor=self.embedding_output,
-                            attention_mask=attention_mask,
-                            sub_attention_mask=sub_attention_mask,
-                            hidden_size=config.hidden_size,
-                            num_hidden_layers=config.num_hidden_layers,
-                            num_attention_heads=config.num_attention_heads,
-                            intermediate_size=config.intermediate_size,
-                            intermediate_act_fn=get_activation(config.hidden_act),
-                            hidden_dropout_prob=config.hidden_dropout_prob,
-                            attention_probs_dropout_prob=config.attention_probs_dropout_prob,
-                            initializer_range=config.initializer_range,
-                            do_return_all_layers=True)
-                        
-                        #print('trans op::',self.all_encoder_layers)
-                        self.sequence_output = self.all_encoder_layers[-1]
-                        #print('aftr trans op::',self.sequence_output)
-                        #self.sequence_output = tf.stop_gradient(self.sequence_output)
+
+                    # Run the stacked transformer.
+                    # `sequence_output` shape = [batch_size, seq_length, hidden_size].
+                    self.all_encoder_layers = transformer_model(
+                        input_tensor=self.embedding_output,
+                        input_mask=input_mask_1d,
+                        sub_attention_mask=sub_attention_mask,
+                        hidden_size=config.hidden_size,
+                        num_hidden_layers=config.num_hidden_layers,
+                        num_attention_heads=config.num_attention_heads,
+                        intermediate_size=config.intermediate_size,
+                        intermediate_act_fn=get_activation(config.hidden_act),
+                        hidden_dropout_prob=config.hidden_dropout_prob,
+                        attention_probs_dropout_prob=config.attention_probs_dropout_prob,
+                        initializer_range=config.initializer_range,
+                        do_return_all_layers=True,
+                        use_xla_jit=use_xla_jit,
+                        use_bfloat16=use_bfloat16,
+                        use_packed_qkv=use_packed_qkv,
+                        use_fused_gelu=use_fused_gelu and not is_training)
+
+                    #print('trans op::',self.all_encoder_layers)
+                    self.sequence_output = self.all_encoder_layers[-1]
+                    #print('aftr trans op::',self.sequence_output)
+                    #self.sequence_output = tf.stop_gradient(self.sequence_output)
                 
                 # The "pooler" converts the encoded sequence tensor of shape
                 # [batch_size, seq_length, hidden_size] to a tensor of shape
@@ -304,27 +379,47 @@ class BertModel(object):
                     # We "pool" the model by simply taking the hidden state corresponding
                     # to the first token. We assume that this has been pre-trained
                     
-                    first_token_tensor = tf.squeeze(self.sequence_output[:, 0:1, :], axis=1)
+                    first_token_tensor = self.sequence_output[:, 0, :]
                     
                     # We "pool" the model by simply taking the hidden state corresponding
-                    # to the terminal 'SEP' token. We assume that this has been pre-trained
-                    index = tf.where(tf.equal(input_ids, 1475))
-                    second_token_tensor = tf.gather_nd(self.sequence_output, index)
-                    input_shape = get_shape_list(self.sequence_output, expected_rank=3)
-                    second_token_tensor = tf.reshape(second_token_tensor, [input_shape[0], input_shape[2]])
+                    # to the terminal 'SEP' token. We assume that this has been pre-trained.
+                    # argmax on the equality mask keeps the shape static, unlike
+                    # tf.where whose output size is only known at run time.
+                    sep_index = tf.argmax(
+                        tf.cast(tf.equal(input_ids, config.sep_token_id), tf.int32), axis=1)
+                    second_token_tensor = tf.gather(
+                        self.sequence_output, sep_index, batch_dims=1)
                     #first_token_tensor = tf.concat([self.sequence_output[:,0:1,:],second_token_tensor],1)
-                    self.pooled_output = tf.layers.dense(
-                        first_token_tensor,
-                        config.hidden_size,
-                        activation=tf.tanh,
-                        kernel_initializer=create_initializer(config.initializer_range))
+                    if use_quantized_inference and not is_training:
+                        self.pooled_output = quantized_dense(
+                            first_token_tensor,
+                            config.hidden_size,
+                            activation=tf.tanh,
+                            kernel_initializer=create_initializer(config.initializer_range),
+                            name="dense")
+                    else:
+                        self.pooled_output = tf.layers.dense(
+                            first_token_tensor,
+                            config.hidden_size,
+                            activation=tf.tanh,
+                            kernel_initializer=create_initializer(config.initializer_range))
                     #self.pooled_output = tf.layers.flatten(self.pooled_output)
                 
                         
     def get_cluster_output(self):
+        if self.cluster_output is None:
+            raise ValueError(
+                "cluster_output is not materialized by the fused embedding "
+                "lookup; construct BertModel with use_one_hot_embeddings=True "
+                "to keep the separate per-table outputs.")
         return self.cluster_output
     
     def get_word_output(self):
+        if self.word_output is None:
+            raise ValueError(
+                "word_output is not materialized by the fused embedding "
+                "lookup; construct BertModel with use_one_hot_embeddings=True "
+                "to keep the separate per-table outputs.")
         return self.word_output
                 
     def get_concat_output(self):
@@ -363,9 +458,12 @@ class BertModel(object):
         return self.embedding_table
 
 
+# 1/sqrt(2), folded into gelu so no scalar sqrt op lands in the graph.
+INV_SQRT2 = 0.7071067811865475
+
 def gelu(input_tensor):
     """Gaussian Error Linear Unit.
-    
+
     This is a smoother version of the RELU.
     Original paper: https://arxiv.org/abs/1606.08415
 
@@ -375,8 +473,26 @@ def gelu(input_tensor):
     Returns:
         `input_tensor` with the GELU activation applied.
     """
-    
-    cdf = 0.5 * (1.0 + tf.erf(input_tensor / tf.sqrt(2.0)))
+
+    cdf = 0.5 * (1.0 + tf.erf(input_tensor * INV_SQRT2))
+    return input_tensor * cdf
+
+
+def gelu_approx(input_tensor):
+    """Tanh approximation of the GELU.
+
+    This is the form the fused `GeluApproximate` kernels implement, and it
+    lowers to a single elementwise kernel under XLA.
+
+    Args:
+        input_tensor: float Tensor to perform activation.
+
+    Returns:
+        `input_tensor` with the approximate GELU activation applied.
+    """
+
+    cdf = 0.5 * (1.0 + tf.tanh(0.7978845608028654 *
+                               (input_tensor + 0.044715 * tf.pow(input_tensor, 3.0))))
     return input_tensor * cdf
 
 
@@ -411,37 +527,41 @@ def get_activation(activation_string):
         return tf.nn.relu
     elif act == "gelu":
         return gelu
+    elif act == "gelu_approx":
+        return gelu_approx
     elif act == "tanh":
         return tf.tanh
     else:
         raise ValueError("Unsupported activation: %s" % act)
 
 
+_TENSOR_NAME_RE = re.compile(r"^(.*):\d+$")
+
 def get_assignment_map_from_checkpoint(tvars, init_checkpoint):
-    
+
     """Compute the union of the current variables and checkpoint variables."""
-    
-    assignment_map = {}
+
     initialized_variable_names = {}
 
-    name_to_variable = collections.OrderedDict()
+    # Plain dicts preserve insertion order on Python 3.7+.
+    name_to_variable = {}
     for var in tvars:
         name = var.name
         #if name == 'bert/embeddings/word_embeddings:0':
         #if name == 'bert/embeddings/cluster_embeddings:0' or name == 'bert/embeddings/context_embeddings:0':
         #    continue
-        
+
         if name == 'output_weights:0' or name == 'output_bias:0':
             continue
-        
-        m = re.match("^(.*):\\d+$", name)
+
+        m = _TENSOR_NAME_RE.match(name)
         if m is not None:
             name = m.group(1)
         name_to_variable[name] = var
 
     init_vars = tf.train.list_variables(init_checkpoint)
 
-    assignment_map = collections.OrderedDict()
+    assignment_map = {}
     for x in init_vars:
         (name, var) = (x[0], x[1])
         if name not in name_to_variable:
@@ -478,14 +598,135 @@ def layer_norm(input_tensor, name=None):
         inputs=input_tensor, begin_norm_axis=-1, begin_params_axis=-1, scope=name)
 
 
-def layer_norm_and_dropout(input_tensor, dropout_prob, name=None):
-    
-    """Runs layer normalization followed by dropout."""
-    output_tensor = layer_norm(input_tensor, name)
-    output_tensor = dropout(output_tensor, dropout_prob)
+def add_layer_norm(input_tensor, residual_tensor, name=None,
+                   use_xla_jit=False):
+
+    """Residual add followed by layer normalization as one fusable block.
+
+    When `use_xla_jit` is set, the jit scope lets XLA fold the elementwise
+    add into the normalization's reduction pass, so the summed tensor never
+    round-trips through memory on its own. JIT compilation stays opt-in,
+    matching the encoder.
+    """
+    with jit_scope(use_xla_jit):
+        return layer_norm(input_tensor + residual_tensor, name)
+
+
+def layer_norm_and_dropout(input_tensor, dropout_prob, name=None,
+                           use_xla_jit=False):
+
+    """Runs layer normalization followed by dropout.
+
+    Both ops stream the full tensor, so when `use_xla_jit` is set they are
+    grouped under a jit scope that lets XLA fuse the normalization and the
+    dropout mask multiply into a single memory pass. JIT compilation stays
+    opt-in, matching the encoder.
+    """
+    with jit_scope(use_xla_jit):
+        output_tensor = layer_norm(input_tensor, name)
+        output_tensor = dropout(output_tensor, dropout_prob)
     return output_tensor
 
 
+def quantize_weights(weights, name=None):
+
+    """Symmetric INT8 fake quantization of a weight tensor for inference.
+
+    The range is taken from the tensor itself (dynamic-range quantization),
+    so no calibration pass is required. Graph converters (TF-Lite, oneDNN)
+    can lower the quantize/dequantize pair to real INT8 kernels.
+    """
+    return tf.quantization.quantize_and_dequantize(
+        weights, input_min=0.0, input_max=0.0, signed_input=True,
+        num_bits=8, range_given=False, name=name)
+
+
+def quantized_dense(input_tensor, units, activation=None,
+                    kernel_initializer=None, name=None):
+
+    """Dense layer whose kernel goes through INT8 fake quantization.
+
+    Mirrors `tf.layers.dense` variable naming (`kernel`/`bias`) so
+    checkpoints load unchanged; only the inference-time matmul sees the
+    quantized weights.
+    """
+    input_width = input_tensor.shape[-1]
+    with tf.variable_scope(name, default_name="dense"):
+        kernel = tf.get_variable(
+            name="kernel",
+            shape=[input_width, units],
+            initializer=kernel_initializer)
+        bias = tf.get_variable(
+            name="bias",
+            shape=[units],
+            initializer=tf.zeros_initializer())
+        output = tf.nn.bias_add(tf.matmul(input_tensor, quantize_weights(kernel)), bias)
+        if activation is not None:
+            output = activation(output)
+    return output
+
+
+def fused_dense_gelu(input_tensor, units, initializer_range, name=None):
+
+    """Dense + bias + approximate GELU as a single fused matmul.
+
+    Uses oneDNN's `_FusedMatMul` kernel when this TF build exposes it
+    (requires TF_ENABLE_ONEDNN_OPTS=1), collapsing the
+    MatMul -> BiasAdd -> GELU chain into one call; otherwise falls back to
+    the unfused chain with the matching approximate GELU. Variable naming
+    mirrors `tf.layers.dense` so checkpoints load unchanged.
+
+    Inference-only opt-in (see `use_fused_gelu` on `transformer_model`):
+    `_FusedMatMul` has no registered gradient so any training graph would
+    fail in `tf.gradients`, an unsupported `fused_ops` combination is only
+    rejected at kernel instantiation during `session.run` where no Python
+    fallback can catch it, and both branches use the tanh GELU
+    approximation rather than the exact erf form.
+    """
+    input_width = input_tensor.shape[-1]
+    with tf.variable_scope(name, default_name="dense"):
+        kernel = tf.get_variable(
+            name="kernel",
+            shape=[input_width, units],
+            initializer=create_initializer(initializer_range))
+        bias = tf.get_variable(
+            name="bias",
+            shape=[units],
+            initializer=tf.zeros_initializer())
+
+        fused_matmul = getattr(getattr(tf, "raw_ops", None), "_FusedMatMul", None)
+        if fused_matmul is not None:
+            try:
+                # `num_args` is an attr the wrapper infers from len(args);
+                # passing it explicitly is a TypeError that would silently
+                # disable the fused branch.
+                return fused_matmul(a=input_tensor, b=kernel, args=[bias],
+                                    fused_ops=["BiasAdd", "GeluApproximate"])
+            except (TypeError, ValueError):
+                pass
+
+        output = tf.nn.bias_add(tf.matmul(input_tensor, kernel), bias)
+        return gelu_approx(output)
+
+
+def jit_scope(enable=True):
+
+    """Returns an XLA jit scope when requested and available.
+
+    XLA fuses the elementwise chains (bias add, gelu, dropout, layer norm,
+    softmax) into the surrounding matmul kernels, cutting intermediate
+    tensor traffic. Falls back to a no-op scope when disabled or when the
+    contrib compiler is unavailable.
+    """
+    if enable:
+        try:
+            return tf.contrib.compiler.jit.experimental_jit_scope()
+        except (AttributeError, ImportError):
+            tf.logging.warning("XLA jit scope requested but unavailable; "
+                               "running without JIT compilation.")
+    return contextlib.suppress()
+
+
 def create_initializer(initializer_range=0.02):
     
     """Creates a `truncated_normal_initializer` with the given range."""
@@ -501,26 +742,142 @@ def static_initializer(feature_locale, cluster_size, embedding_size):
             Context Embedding Matrix
     '''    
     
+    tsv_locale = os.path.join(feature_locale,'embedding.tsv')
+    npy_locale = os.path.join(feature_locale,'embedding.npy')
+
+    # The tsv is only parsed when the binary cache is missing or stale; a
+    # cache without a tsv next to it (e.g. only the .npy was deployed) is
+    # trusted as-is. Afterwards the table is memory-mapped straight from
+    # embedding.npy so start-up touches no text parsing and the OS pages
+    # rows in on demand.
+    tsv_is_local = os.path.exists(tsv_locale)
+    if (os.path.exists(npy_locale)
+            and (not tsv_is_local
+                 or os.path.getmtime(npy_locale) >= os.path.getmtime(tsv_locale))):
+        try:
+            static_embed = np.load(npy_locale, mmap_mode='r').astype(
+                np.float32, copy=False)
+            if static_embed.shape != (cluster_size, embedding_size):
+                raise ValueError(
+                    "embedding cache %s has shape %s, expected (%d, %d)" %
+                    (npy_locale, static_embed.shape, cluster_size,
+                     embedding_size))
+            return(static_embed)
+        except (IOError, OSError, ValueError):
+            # A crash mid-write or a stale deployment can leave a cache that
+            # no longer loads; rebuild from the tsv rather than failing
+            # every startup until the file is deleted by hand.
+            tf.logging.warning("Embedding cache %s is unreadable or stale; "
+                               "rebuilding from embedding.tsv.", npy_locale)
+
     static_embed = np.zeros((cluster_size, embedding_size), dtype=np.float32)
-    feature_locale = os.path.join(feature_locale,'embedding.tsv')
-    with tf.gfile.Open(feature_locale, "r") as readBuffer:
-        reader = csv.reader(readBuffer, delimiter="\t", quotechar=None)
-        index = 0
-        for line in reader:
-            decoyArray = np.array(list(map(lambda currVal : float(currVal.strip()), line[1].split(','))))
-            static_embed[index] = decoyArray
-            index = index+1
-    
+
+    if not tsv_is_local:
+        # Non-local paths (e.g. GCS) cannot be memory-mapped; stream the
+        # file through tf.gfile as the original parser did.
+        with tf.gfile.Open(tsv_locale, "r") as readBuffer:
+            index = -1
+            for index, line in enumerate(readBuffer):
+                row = line.rstrip("\n").split("\t", 1)[1]
+                static_embed[index] = np.fromstring(row, dtype=np.float32, sep=',')
+        if index + 1 != cluster_size:
+            raise ValueError(
+                "%s holds %d rows, expected %d" %
+                (tsv_locale, index + 1, cluster_size))
+        return(static_embed)
+
+    with open(tsv_locale, "rb") as readBuffer:
+        mapped = mmap.mmap(readBuffer.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Locate row boundaries once, then decode slices of the mapped
+            # file in parallel; numpy releases the GIL inside fromstring so
+            # the workers scale with cores.
+            offsets = [0]
+            pos = mapped.find(b"\n")
+            while pos != -1:
+                offsets.append(pos + 1)
+                pos = mapped.find(b"\n", pos + 1)
+            bounds = [(start, end) for start, end
+                      in zip(offsets, offsets[1:] + [mapped.size()])
+                      if end > start + 1]
+
+            def decode_rows(chunk):
+                for index, (start, end) in chunk:
+                    row = mapped[start:end].split(b"\t", 1)[1]
+                    static_embed[index] = np.fromstring(row, dtype=np.float32, sep=',')
+
+            rows = list(enumerate(bounds))
+            worker_count = min(os.cpu_count() or 1, 8)
+            chunk_size = max(1, (len(rows) + worker_count - 1) // worker_count)
+            chunks = [rows[start:start + chunk_size]
+                      for start in range(0, len(rows), chunk_size)]
+            with futures.ThreadPoolExecutor(max_workers=worker_count) as pool:
+                list(pool.map(decode_rows, chunks))
+        finally:
+            mapped.close()
+
+    if len(bounds) != cluster_size:
+        raise ValueError(
+            "%s holds %d rows, expected %d" %
+            (tsv_locale, len(bounds), cluster_size))
+    try:
+        # Best effort: the cache is an optimization, so a read-only data
+        # directory must not fail the lookup. The write goes to a per-pid
+        # temp file and is renamed into place so a crash mid-save or a
+        # concurrent job (the Estimator flow builds train and predict
+        # graphs separately) never exposes a truncated embedding.npy.
+        tmp_locale = "%s.%d.tmp" % (npy_locale, os.getpid())
+        with open(tmp_locale, "wb") as writeBuffer:
+            np.save(writeBuffer, static_embed)
+        os.replace(tmp_locale, npy_locale)
+    except (IOError, OSError):
+        tf.logging.warning("Could not write embedding cache %s; continuing "
+                           "without it.", npy_locale)
     return(static_embed)
 
 
+# Vocabulary sizes at or below the limit keep the one-hot matmul (a small
+# dense GEMM that saturates matrix units); sizes at or above the floor are
+# forced onto the gather path regardless of the caller's flag.
+_ONE_HOT_VOCAB_LIMIT = 256
+_GATHER_VOCAB_FLOOR = 4096
+
+def select_one_hot_path(use_one_hot_embeddings, vocab_size, table_name):
+
+    """Specializes the lookup strategy on the vocab size known at build time.
+
+    Args:
+        use_one_hot_embeddings: bool. The caller's requested strategy.
+        vocab_size: int. Number of rows in the embedding table.
+        table_name: string. Table name, only used for logging.
+
+    Returns:
+        bool. Whether the one-hot matmul path should be used.
+    """
+    if not isinstance(vocab_size, int):
+        return use_one_hot_embeddings
+
+    if use_one_hot_embeddings and vocab_size >= _GATHER_VOCAB_FLOOR:
+        selected = False
+    elif not use_one_hot_embeddings and vocab_size <= _ONE_HOT_VOCAB_LIMIT:
+        selected = True
+    else:
+        selected = use_one_hot_embeddings
+
+    if selected != use_one_hot_embeddings:
+        tf.logging.info("%s lookup: vocab_size=%d, overriding to one_hot=%s",
+                        table_name, vocab_size, selected)
+    return selected
+
+
 def embedding_lookup(input_ids,
                      vocab_size,
                      embedding_size=128,
                      initializer_range=0.02,
                      word_embedding_name="word_embeddings",
-                     use_one_hot_embeddings=False):
-    
+                     use_one_hot_embeddings=False,
+                     embedding_dtype=tf.float32):
+
     """Looks up words embeddings for id tensor.
 
     Args:
@@ -531,6 +888,8 @@ def embedding_lookup(input_ids,
         word_embedding_name: string. Name of the embedding table.
         use_one_hot_embeddings: bool. If True, use one-hot method for word
         embeddings. If False, use `tf.nn.embedding_lookup()`. One hot is better for TPUs.
+        embedding_dtype: storage dtype for the table. tf.bfloat16 halves the
+        gather bandwidth; the output is always cast back to float32.
 
     Returns:
         float Tensor of shape [batch_size, seq_length, embedding_size].
@@ -541,23 +900,38 @@ def embedding_lookup(input_ids,
     # If the input is a 2D tensor of shape [batch_size, seq_length], we
     # reshape to [batch_size, seq_length, 1].
     
-    if input_ids.shape.ndims == 2:
-        input_ids = tf.expand_dims(input_ids, axis=[-1])
-    
+    use_one_hot_embeddings = select_one_hot_path(
+        use_one_hot_embeddings, vocab_size, word_embedding_name)
+
     embedding_table = tf.get_variable(
         name=word_embedding_name,
         shape=[vocab_size, embedding_size],
+        dtype=embedding_dtype,
         initializer=create_initializer(initializer_range))
-  
-  
+
+    if input_ids.shape.ndims == 2 and not use_one_hot_embeddings:
+        # A gather on 2D ids already returns [batch_size, seq_length,
+        # embedding_size]; the expand_dims/reshape round trip is only
+        # needed for higher-rank inputs.
+        output = tf.nn.embedding_lookup(embedding_table, input_ids)
+        if embedding_dtype != tf.float32:
+            output = tf.cast(output, tf.float32)
+        return (output, embedding_table)
+
+    if input_ids.shape.ndims == 2:
+        input_ids = tf.expand_dims(input_ids, axis=[-1])
+
     if use_one_hot_embeddings:
         flat_input_ids = tf.reshape(input_ids, [-1])
-        one_hot_input_ids = tf.one_hot(flat_input_ids, depth=vocab_size)
+        one_hot_input_ids = tf.one_hot(flat_input_ids, depth=vocab_size, dtype=embedding_dtype)
         output = tf.matmul(one_hot_input_ids, embedding_table)
     else:
         #embedding lookup from the table
         output = tf.nn.embedding_lookup(embedding_table, input_ids)
-        
+
+    if embedding_dtype != tf.float32:
+        output = tf.cast(output, tf.float32)
+
     input_shape = get_shape_list(input_ids)
 
     output = tf.reshape(output,
@@ -569,9 +943,10 @@ def cluster_embedding_lookup(cluster_ids,
                              feature_locale, 
                              cluster_size, 
                              embedding_size=128, 
-                             context_embedding_name="cluster_embeddings", 
-                             use_one_hot_embeddings=False):
-    
+                             context_embedding_name="cluster_embeddings",
+                             use_one_hot_embeddings=False,
+                             embedding_dtype=tf.float32):
+
     """Looks up POS context feature embeddings for id tensor.
 
     Args:
@@ -592,9 +967,6 @@ def cluster_embedding_lookup(cluster_ids,
     # If the input is a 2D tensor of shape [batch_size, seq_length], we
     # reshape to [batch_size, seq_length, 1].
     
-    if cluster_ids.shape.ndims == 2:
-        cluster_ids = tf.expand_dims(cluster_ids, axis=[-1])
-    
     '''
     cluster_embedding_table = tf.get_variable(
         name=context_embedding_name,
@@ -602,18 +974,36 @@ def cluster_embedding_lookup(cluster_ids,
         initializer=create_initializer(0.02))
     '''
     
+    use_one_hot_embeddings = select_one_hot_path(
+        use_one_hot_embeddings, cluster_size, context_embedding_name)
+
     cluster_embedding_table = tf.get_variable(
         name=context_embedding_name,
-        initializer=static_initializer(feature_locale, cluster_size, embedding_size))
-    
+        initializer=static_initializer(feature_locale, cluster_size, embedding_size)
+            .astype(embedding_dtype.as_numpy_dtype))
+
+    if cluster_ids.shape.ndims == 2 and not use_one_hot_embeddings:
+        # Direct gather keeps the [batch_size, seq_length, embedding_size]
+        # shape with no expand_dims/reshape round trip.
+        cluster_output = tf.nn.embedding_lookup(cluster_embedding_table, cluster_ids)
+        if embedding_dtype != tf.float32:
+            cluster_output = tf.cast(cluster_output, tf.float32)
+        return (cluster_output, cluster_embedding_table)
+
+    if cluster_ids.shape.ndims == 2:
+        cluster_ids = tf.expand_dims(cluster_ids, axis=[-1])
+
     if use_one_hot_embeddings:
         flat_input_ids = tf.reshape(cluster_ids, [-1])
-        one_hot_input_ids = tf.one_hot(flat_input_ids, depth=cluster_size)
+        one_hot_input_ids = tf.one_hot(flat_input_ids, depth=cluster_size, dtype=embedding_dtype)
         cluster_output = tf.matmul(one_hot_input_ids, cluster_embedding_table)
     else:
         #embedding lookup from the table
         cluster_output = tf.nn.embedding_lookup(cluster_embedding_table, cluster_ids)
-        
+
+    if embedding_dtype != tf.float32:
+        cluster_output = tf.cast(cluster_output, tf.float32)
+
     input_shape = get_shape_list(cluster_ids)
 
     cluster_output = tf.reshape(cluster_output,
@@ -622,7 +1012,144 @@ def cluster_embedding_lookup(cluster_ids,
     return (cluster_output, cluster_embedding_table)
 
 
-def distance_embedding_lookup(input_ids, distance_size, 
+def fused_embedding_lookup(input_ids,
+                           cluster_ids,
+                           feature_locale,
+                           vocab_size,
+                           cluster_size,
+                           embedding_size=128,
+                           initializer_range=0.02,
+                           word_embedding_name="word_embeddings",
+                           context_embedding_name="cluster_embeddings",
+                           embedding_dtype=tf.float32,
+                           use_concat_gather=False):
+
+    """Looks up word and POS cluster embeddings and sums them in one place.
+
+    By default the two tables are gathered separately and summed with a
+    single `tf.add_n`; the concat form is opt-in because
+    `tf.concat` over the two variables is a graph op that re-copies the
+    full word table every `session.run`, which for realistic batch sizes
+    costs far more memory traffic than the add it saves. With
+    `use_concat_gather` the tables are concatenated along the row axis and
+    the cluster ids offset by `vocab_size`, so one `tf.nn.embedding_lookup`
+    over stacked `[batch_size, seq_length, 2]` ids replaces the two gathers
+    plus the add -- only worthwhile where a rewrite caches the combined
+    table. Either way the two tables keep their original variable names so
+    checkpoints remain compatible.
+
+    Args:
+        input_ids: int32 Tensor of shape [batch_size, seq_length] containing word ids.
+        cluster_ids: int32 Tensor of shape [batch_size, seq_length] containing cluster ids.
+        feature_locale: local path for the ULE matrix.
+        vocab_size: int. Size of the word embedding vocabulary.
+        cluster_size: int. Size of the cluster embedding vocabulary.
+        embedding_size: int. Width of the embeddings.
+        initializer_range: float. Embedding initialization range.
+        word_embedding_name: string. Name of the word embedding table.
+        context_embedding_name: string. Name of the cluster embedding table.
+        embedding_dtype: storage dtype for the tables; the output is always
+        cast back to float32.
+        use_concat_gather: bool. Use the concatenated-table gather instead
+        of two gathers + add_n; see above.
+
+    Returns:
+        float Tensor of shape [batch_size, seq_length, embedding_size] holding
+        the summed word and cluster embeddings, plus the two tables.
+    """
+
+    embedding_table = tf.get_variable(
+        name=word_embedding_name,
+        shape=[vocab_size, embedding_size],
+        dtype=embedding_dtype,
+        initializer=create_initializer(initializer_range))
+
+    cluster_embedding_table = tf.get_variable(
+        name=context_embedding_name,
+        initializer=static_initializer(feature_locale, cluster_size, embedding_size)
+            .astype(embedding_dtype.as_numpy_dtype))
+
+    if use_concat_gather:
+        combined_table = tf.concat([embedding_table, cluster_embedding_table],
+                                   axis=0)
+
+        # `stacked_ids` = [batch_size, seq_length, 2]
+        stacked_ids = tf.stack([input_ids, cluster_ids + vocab_size], axis=-1)
+        gathered = tf.nn.embedding_lookup(combined_table, stacked_ids)
+        output = tf.reduce_sum(gathered, axis=2)
+    else:
+        output = tf.add_n([
+            tf.nn.embedding_lookup(embedding_table, input_ids),
+            tf.nn.embedding_lookup(cluster_embedding_table, cluster_ids)])
+
+    if embedding_dtype != tf.float32:
+        output = tf.cast(output, tf.float32)
+
+    return (output, embedding_table, cluster_embedding_table)
+
+
+_ABS_DIST_CACHE = {}
+
+def abs_distance_matrix(seq_length):
+    '''
+        Absolute relative distance matrix |i-j|, computed once per static
+        sequence length and cached at module level.
+
+        Args:
+            seq_length = static sequence length
+        Returns:
+            float32 ndarray of shape [seq_length, seq_length]
+    '''
+    if seq_length not in _ABS_DIST_CACHE:
+        position_index = np.arange(seq_length)
+        _ABS_DIST_CACHE[seq_length] = np.abs(
+            np.subtract.outer(position_index, position_index)).astype(np.float32)
+
+    return _ABS_DIST_CACHE[seq_length]
+
+
+_MARG_DIST_CACHE = {}
+
+def marg_dist_matrix(distance_size):
+    '''
+        Row-softmaxed marginal distance matrix softmax(|i-j|), computed once
+        per distance_size in numpy and cached at module level.
+
+        Args:
+            distance_size = number of relative positions
+        Returns:
+            float32 ndarray of shape [distance_size, distance_size]
+    '''
+    if distance_size not in _MARG_DIST_CACHE:
+        marg_dist = abs_distance_matrix(distance_size)
+        marg_dist = np.exp(marg_dist - marg_dist.max(axis=-1, keepdims=True))
+        marg_dist = marg_dist / marg_dist.sum(axis=-1, keepdims=True)
+        _MARG_DIST_CACHE[distance_size] = marg_dist
+
+    return _MARG_DIST_CACHE[distance_size]
+
+
+_DIST_BIAS_CACHE = {}
+
+def dist_bias_matrix(seq_length):
+    '''
+        Distance attention bias 0.5 - softmax(|i-j|). Every term is static
+        for a given sequence length, so the whole bias reduces to a cached
+        constant and no softmax runs in the graph.
+
+        Args:
+            seq_length = static sequence length
+        Returns:
+            float32 ndarray of shape [seq_length, seq_length]
+    '''
+    if seq_length not in _DIST_BIAS_CACHE:
+        _DIST_BIAS_CACHE[seq_length] = (
+            0.5 - marg_dist_matrix(seq_length)).astype(np.float32)
+
+    return _DIST_BIAS_CACHE[seq_length]
+
+
+def distance_embedding_lookup(input_ids, distance_size,
                              embedding_size=128, 
                              distance_embedding_name="distance_embeddings", 
                              use_one_hot_embeddings=False):
@@ -639,34 +1166,30 @@ def distance_embedding_lookup(input_ids, distance_size,
         float Tensor of shape [batch_size, seq_length, embedding_size].
     """
     if input_ids.shape.ndims == 2:
-        input_ids = tf.expand_dims(input_ids, axis=[-1])
-    
+        # The one-hot matmul below flattens the ids anyway, so 2D inputs
+        # need no expand_dims; only the final reshape target differs.
+        output_shape = get_shape_list(input_ids) + [embedding_size]
+    else:
+        input_shape = get_shape_list(input_ids)
+        output_shape = input_shape[0:-1] + [input_shape[-1] * embedding_size]
+
     distance_embedding_table = tf.get_variable(
         name=distance_embedding_name,
         shape=[distance_size, embedding_size],
         initializer=create_initializer(0.02))
     
-    distance_correlation_tensor = tf.matmul(distance_embedding_table, 
+    distance_correlation_tensor = tf.matmul(distance_embedding_table,
                                             distance_embedding_table, transpose_b=True)
-    dist_array = np.arange(distance_size)
-    dist_attn = np.zeros((distance_size, distance_size))
-    for index in range(dist_attn.shape[0]):
-        dist_attn[index] = (dist_array-index)
-    marg_dist = (np.tril(dist_attn, 0)*-1) + (np.triu(dist_attn, 0)*1)
-    marg_dist = tf.cast(marg_dist, tf.float32)
-    marg_dist = tf.nn.softmax(marg_dist)
+    marg_dist = tf.constant(marg_dist_matrix(distance_size), dtype=tf.float32)
     distance_correlation_tensor = (distance_correlation_tensor-marg_dist)
     
     distance_output = tf.matmul(distance_correlation_tensor, distance_embedding_table)
     flat_mask_ids = tf.reshape(input_ids, [-1])
     one_hot_mask = tf.one_hot(flat_mask_ids, depth=distance_size)
     distance_output = tf.matmul(one_hot_mask, distance_output)
-    
-    input_shape = get_shape_list(input_ids)
-    
-    distance_output = tf.reshape(distance_output,
-                        input_shape[0:-1] + [input_shape[-1] * embedding_size])
-  
+
+    distance_output = tf.reshape(distance_output, output_shape)
+
     return (distance_output, distance_embedding_table)
 
 
@@ -675,9 +1198,10 @@ def context_embedding_lookup(input_tensor,
                              feature_locale, 
                              cluster_size, 
                              embedding_size=128, 
-                             context_embedding_name="context_embeddings", 
-                             use_one_hot_embeddings=False):
-    
+                             context_embedding_name="context_embeddings",
+                             use_one_hot_embeddings=False,
+                             embedding_dtype=tf.float32):
+
     """Looks up Chunnk n-frame embeddings for id tensor.
 
     Args:
@@ -697,9 +1221,6 @@ def context_embedding_lookup(input_tensor,
     # If the input is a 2D tensor of shape [batch_size, seq_length], we
     # reshape to [batch_size, seq_length, 1].
     output = input_tensor
-    if context_ids.shape.ndims == 2:
-        context_ids = tf.expand_dims(context_ids, axis=[-1])
-    
     '''
     cluster_embedding_table = tf.get_variable(
         name=context_embedding_name,
@@ -707,18 +1228,36 @@ def context_embedding_lookup(input_tensor,
         initializer=create_initializer(0.02))
     '''
     
+    use_one_hot_embeddings = select_one_hot_path(
+        use_one_hot_embeddings, cluster_size, context_embedding_name)
+
     context_embedding_table = tf.get_variable(
         name=context_embedding_name,
-        initializer=static_initializer(feature_locale, cluster_size, embedding_size))
-    
+        initializer=static_initializer(feature_locale, cluster_size, embedding_size)
+            .astype(embedding_dtype.as_numpy_dtype))
+
+    if context_ids.shape.ndims == 2 and not use_one_hot_embeddings:
+        # Direct gather keeps the [batch_size, seq_length, embedding_size]
+        # shape with no expand_dims/reshape round trip.
+        context_output = tf.nn.embedding_lookup(context_embedding_table, context_ids)
+        if embedding_dtype != tf.float32:
+            context_output = tf.cast(context_output, tf.float32)
+        return (context_output, context_embedding_table)
+
+    if context_ids.shape.ndims == 2:
+        context_ids = tf.expand_dims(context_ids, axis=[-1])
+
     if use_one_hot_embeddings:
         flat_input_ids = tf.reshape(context_ids, [-1])
-        one_hot_input_ids = tf.one_hot(flat_input_ids, depth=cluster_size)
+        one_hot_input_ids = tf.one_hot(flat_input_ids, depth=cluster_size, dtype=embedding_dtype)
         context_output = tf.matmul(one_hot_input_ids, context_embedding_table)
     else:
         #embedding lookup from the table
         context_output = tf.nn.embedding_lookup(context_embedding_table, context_ids)
-        
+
+    if embedding_dtype != tf.float32:
+        context_output = tf.cast(context_output, tf.float32)
+
     input_shape = get_shape_list(context_ids)
 
     context_output = tf.reshape(context_output,
@@ -740,7 +1279,8 @@ def embedding_postprocessor(input_tensor,
                             use_entity_embedding=True,
                             entity_embedding_name="entity_embeddings",
                             entity_type_ids=None,
-                            dropout_prob=0.1):
+                            dropout_prob=0.1,
+                            use_xla_jit=False):
     
     """Performs various post-processing on a word embedding tensor.
 
@@ -762,6 +1302,8 @@ def embedding_postprocessor(input_tensor,
         used with this model. This can be longer than the sequence length of
         input_tensor, but cannot be shorter.
         dropout_prob: float. Dropout probability applied to the final output tensor.
+        use_xla_jit: bool. Whether to JIT-compile the trailing layer norm +
+        dropout; kept opt-in to match the encoder.
 
     Returns:
         float tensor with same shape as `input_tensor`.
@@ -775,7 +1317,24 @@ def embedding_postprocessor(input_tensor,
     seq_length = input_shape[1]
     width = input_shape[2]
 
-    output = input_tensor
+    # One initializer object shared by the token/position/entity tables.
+    embedding_initializer = create_initializer(initializer_range)
+
+    # Each enabled embedding appends to embed_adds; a single add_n at the
+    # end sums them in one n-ary kernel instead of one pairwise add per
+    # embedding type.
+    embed_adds = [input_tensor]
+
+    # When two or more tables are enabled, their rows are concatenated into
+    # one combined table, each id stream is offset by the rows that precede
+    # its table, and a single gather plus a reduce_sum over the stacked ids
+    # replaces one gather/slice + add per table (the EmbeddingBag pattern).
+    # The variables themselves keep their original names and shapes, so
+    # existing checkpoints load unchanged.
+    fused_tables = []
+    fused_ids = []
+    fused_rows = 0
+
     if use_token_type:
         if token_type_ids is None:
             raise ValueError("`token_type_ids` must be specified if"
@@ -783,25 +1342,20 @@ def embedding_postprocessor(input_tensor,
         token_type_table = tf.get_variable(
             name=token_type_embedding_name,
             shape=[token_type_vocab_size, width],
-            initializer=create_initializer(initializer_range))
-        
-        # This vocab will be small so we always do one-hot here, since it is always
-        # faster for a small vocabulary.
-        flat_token_type_ids = tf.reshape(token_type_ids, [-1])
-        one_hot_ids = tf.one_hot(flat_token_type_ids, depth=token_type_vocab_size)
-        token_type_embeddings = tf.matmul(one_hot_ids, token_type_table)
-        token_type_embeddings = tf.reshape(token_type_embeddings,
-                                       [batch_size, seq_length, width])
-
-        output += token_type_embeddings
-        
+            initializer=embedding_initializer)
+
+        # First table in the bag, so its ids carry no offset.
+        fused_tables.append(token_type_table)
+        fused_ids.append(token_type_ids)
+        fused_rows += token_type_vocab_size
+
     if use_position_embeddings:
         assert_op = tf.assert_less_equal(seq_length, max_position_embeddings)
         with tf.control_dependencies([assert_op]):
             full_position_embeddings = tf.get_variable(
                 name=position_embedding_name,
                 shape=[max_position_embeddings, width],
-                initializer=create_initializer(initializer_range))
+                initializer=embedding_initializer)
         # Since the position embedding table is a learned variable, we create it
         # using a (long) sequence length `max_position_embeddings`. The actual
         # sequence length might be shorter than this, for faster training of
@@ -809,25 +1363,28 @@ def embedding_postprocessor(input_tensor,
         #
         # So `full_position_embeddings` is effectively an embedding table
         # for position [0, 1, 2, ..., max_position_embeddings-1], and the current
-        # sequence has positions [0, 1, 2, ... seq_length-1], so we can just
-        # perform a slice.
-        
-        position_embeddings = tf.slice(full_position_embeddings, [0, 0],
-                                     [seq_length, -1])
-        num_dims = len(output.shape.as_list())
-
-        # Only the last two dimensions are relevant (`seq_length` and `width`), so
-        # we broadcast among the first dimensions, which is typically just
-        # the batch size.
-        position_broadcast_shape = []
-        for _ in range(num_dims - 2):
-            position_broadcast_shape.append(1)
-        position_broadcast_shape.extend([seq_length, width])
-        position_embeddings = tf.reshape(position_embeddings,
-                                       position_broadcast_shape)
-        
-        output += position_embeddings
-        
+        # sequence has positions [0, 1, 2, ... seq_length-1].
+
+        if fused_tables:
+            # `position_ids` = [batch_size, seq_length]: one [0, seq_length)
+            # row per example, shifted past the tables already in the bag.
+            position_ids = tf.tile(tf.expand_dims(tf.range(seq_length), 0),
+                                   [batch_size, 1])
+            fused_tables.append(full_position_embeddings)
+            fused_ids.append(position_ids + fused_rows)
+            fused_rows += max_position_embeddings
+        elif isinstance(seq_length, int):
+            # Nothing to bag with; a static strided-slice view that grappler
+            # constant-folds beats a per-example gather here.
+            embed_adds.append(tf.broadcast_to(
+                full_position_embeddings[:seq_length],
+                [batch_size, seq_length, width]))
+        else:
+            position_embeddings = tf.slice(full_position_embeddings, [0, 0],
+                                         [seq_length, -1])
+            embed_adds.append(tf.broadcast_to(position_embeddings,
+                                              [batch_size, seq_length, width]))
+
     if use_entity_embedding:
         if entity_type_ids is None:
             raise ValueError("`entity_type_ids` must be specified if"
@@ -835,19 +1392,35 @@ def embedding_postprocessor(input_tensor,
         entity_type_table = tf.get_variable(
             name=entity_embedding_name,
             shape=[token_type_vocab_size, width],
-            initializer=create_initializer(initializer_range))
-        
-        # This vocab will be small so we always do one-hot here, since it is always
-        # faster for a small vocabulary.
-        flat_entity_type_ids = tf.reshape(entity_type_ids, [-1])
-        one_hot_ids = tf.one_hot(flat_entity_type_ids, depth=token_type_vocab_size)
-        entity_type_embeddings = tf.matmul(one_hot_ids, entity_type_table)
-        entity_type_embeddings = tf.reshape(entity_type_embeddings,
-                                       [batch_size, seq_length, width])
-
-        output += entity_type_embeddings
+            initializer=embedding_initializer)
+
+        if fused_tables:
+            fused_tables.append(entity_type_table)
+            fused_ids.append(entity_type_ids + fused_rows)
+            fused_rows += token_type_vocab_size
+        else:
+            # A lone table is already a single gather; bagging it would only
+            # add the stack/reduce overhead.
+            embed_adds.append(tf.gather(entity_type_table, entity_type_ids))
+
+    if len(fused_tables) > 1:
+        # `combined_table` = [sum of table rows, width]
+        combined_table = tf.concat(fused_tables, axis=0)
+        # `stacked_ids` = [batch_size, seq_length, num_tables]
+        stacked_ids = tf.stack(fused_ids, axis=-1)
+        # One gather + one reduction instead of a lookup kernel per table.
+        gathered = tf.gather(combined_table, stacked_ids)
+        embed_adds.append(tf.reduce_sum(gathered, axis=2))
+    elif fused_tables:
+        embed_adds.append(tf.gather(fused_tables[0], fused_ids[0]))
+
+    if len(embed_adds) > 1:
+        output = tf.add_n(embed_adds)
+    else:
+        output = input_tensor
 
-    output = layer_norm_and_dropout(output, dropout_prob)
+    output = layer_norm_and_dropout(output, dropout_prob,
+                                    use_xla_jit=use_xla_jit)
 
     return output
 
@@ -877,11 +1450,9 @@ def context_postprocessor(input_tensor,
             shape=[2, width],
             initializer=create_initializer(initializer_range))
         
-        flat_mask_ids = tf.reshape(mask_ids, [-1])
-        one_hot_mask = tf.one_hot(flat_mask_ids, depth=2)
-        mask_type_embeddings = tf.matmul(one_hot_mask, mask_type_table)
-        mask_type_embeddings = tf.reshape(mask_type_embeddings,
-                                       [batch_size, seq_length, width])
+        # Gathering the 2D ids directly yields [batch_size, seq_length,
+        # width]; no reshape is needed before the add.
+        mask_type_embeddings = tf.gather(mask_type_table, mask_ids)
 
         output += mask_type_embeddings
         
@@ -898,7 +1469,10 @@ def create_attention_mask_from_input_mask(from_tensor, to_mask):
         to_mask: int32 Tensor of shape [batch_size, to_seq_length].
 
     Returns:
-        float Tensor of shape [batch_size, from_seq_length, to_seq_length].
+        int8 Tensor of shape [batch_size, from_seq_length, to_seq_length].
+        The 0/1 mask is stored at one byte per position instead of four;
+        consumers cast to float exactly once (see `transformer_model`), so
+        the wide copy never persists across layers.
     """
     from_shape = get_shape_list(from_tensor, expected_rank=[2, 3])
     batch_size = from_shape[0]
@@ -907,9 +1481,9 @@ def create_attention_mask_from_input_mask(from_tensor, to_mask):
     to_shape = get_shape_list(to_mask, expected_rank=2)
     to_seq_length = to_shape[1]
 
-    broadcast_ones = tf.cast(tf.reshape(to_mask, [batch_size, to_seq_length, 1]), tf.float32)
+    broadcast_ones = tf.cast(tf.reshape(to_mask, [batch_size, to_seq_length, 1]), tf.int8)
 
-    to_mask = tf.cast(tf.reshape(to_mask, [batch_size, 1, to_seq_length]), tf.float32)
+    to_mask = tf.cast(tf.reshape(to_mask, [batch_size, 1, to_seq_length]), tf.int8)
 
     # We don't assume that `from_tensor` is a mask (although it could be). We
     # don't actually care if we attend *from* padding tokens (only *to* padding)
@@ -928,6 +1502,10 @@ def attention_layer(from_tensor,
                     to_tensor,
                     attention_mask=None,
                     sub_attention_mask=None,
+                    dist_bias=None,
+                    attention_adder=None,
+                    use_bfloat16=False,
+                    use_packed_qkv=False,
                     num_attention_heads=1,
                     size_per_head=512,
                     query_act=None,
@@ -935,6 +1513,7 @@ def attention_layer(from_tensor,
                     value_act=None,
                     attention_probs_dropout_prob=0.0,
                     initializer_range=0.02,
+                    kernel_initializer=None,
                     do_return_2d_tensor=False,
                     batch_size=None,
                     from_seq_length=None,
@@ -956,17 +1535,38 @@ def attention_layer(from_tensor,
       interpolated by these probabilities, then concatenated back to a single
       tensor and returned.
     
-      In practice, the multi-headed attention are done with transposes and
-      reshapes rather than actual separate tensors.
+      In practice, the multi-headed attention are done with reshapes and
+      `tf.einsum` contractions rather than actual separate tensors, which
+      keeps the head dimension in place and avoids materializing any
+      transposed copies of Q, K, V or the context.
     
       Args:
         from_tensor: float Tensor of shape [batch_size, from_seq_length,
           from_width].
         to_tensor: float Tensor of shape [batch_size, to_seq_length, to_width].
-        attention_mask: (optional) int32 Tensor of shape [batch_size,
+        attention_mask: (optional) int8/int32 Tensor of shape [batch_size,
           from_seq_length, to_seq_length]. The values should be 1 or 0. The
           attention scores will effectively be set to -infinity for any positions in
           the mask that are 0, and will be unchanged for positions that are 1.
+        dist_bias: (optional) float Tensor of shape [batch_size, 1,
+          from_seq_length, to_seq_length] holding the distance adjusted
+          attention bias, built once per encoder in `transformer_model` and
+          already multiplied by the 1/sqrt(size_per_head) attention scale.
+        attention_adder: (optional) float Tensor of shape [batch_size, 1,
+          from_seq_length, to_seq_length] holding the precomputed additive
+          mask (0.0 to attend, -10000.0 masked), shared across layers. When
+          given, `attention_mask` is not cast again here.
+        use_bfloat16: bool. Run the two attention matmuls in bfloat16,
+          doubling matmul throughput on hardware with bf16 units. The
+          softmax, mask adds and all weights stay in float32.
+        use_packed_qkv: bool. Project Q, K and V (or K and V on the
+          cross-attention path) with one packed dense layer instead of
+          separate ones. The packed layer names its variables "qkv"/"kv",
+          which existing checkpoints with separate query/key/value
+          variables cannot initialize -- get_assignment_map_from_checkpoint
+          matches names exactly -- so this is off by default and should
+          only be enabled when training from scratch or with a repacked
+          checkpoint.
         num_attention_heads: int. Number of attention heads.
         size_per_head: int. Size of each attention head.
         query_act: (optional) Activation function for the query transform.
@@ -975,6 +1575,10 @@ def attention_layer(from_tensor,
         attention_probs_dropout_prob: (optional) float. Dropout probability of the
           attention probabilities.
         initializer_range: float. Range of the weight initializer.
+        kernel_initializer: (optional) shared initializer object for the
+          projection kernels; built from `initializer_range` when absent.
+          Passing one in lets the caller reuse a single object across all
+          layers instead of allocating one per dense call.
         do_return_2d_tensor: bool. If True, the output will be of shape [batch_size
           * from_seq_length, num_attention_heads * size_per_head]. If False, the
           output will be of shape [batch_size, from_seq_length, num_attention_heads
@@ -996,14 +1600,6 @@ def attention_layer(from_tensor,
         ValueError: Any of the arguments or tensor shapes are invalid.
       """
 
-    def transpose_for_scores(input_tensor, batch_size, num_attention_heads, seq_length, width):
-      
-        output_tensor = tf.reshape(
-            input_tensor, [batch_size, seq_length, num_attention_heads, width])
-
-        output_tensor = tf.transpose(output_tensor, [0, 2, 1, 3])
-        return output_tensor
-
     from_shape = get_shape_list(from_tensor, expected_rank=[2, 3])
     to_shape = get_shape_list(to_tensor, expected_rank=[2, 3])
 
@@ -1029,83 +1625,120 @@ def attention_layer(from_tensor,
     #   N = `num_attention_heads`
     #   H = `size_per_head`
 
+    if kernel_initializer is None:
+        kernel_initializer = create_initializer(initializer_range)
+
     from_tensor_2d = reshape_to_matrix(from_tensor)
     to_tensor_2d = reshape_to_matrix(to_tensor)
 
-    # `query_layer` = [B*F, N*H]
-    query_layer = tf.layers.dense(
-        from_tensor_2d,
-        num_attention_heads * size_per_head,
-        activation=query_act,
-        name="query",
-        kernel_initializer=create_initializer(initializer_range))
-    
-
-    # `key_layer` = [B*T, N*H]
-    key_layer = tf.layers.dense(
-        to_tensor_2d,
-        num_attention_heads * size_per_head,
-        activation=key_act,
-        name="key",
-        kernel_initializer=create_initializer(initializer_range))
-    
-    # `value_layer` = [B*T, N*H]
-    value_layer = tf.layers.dense(
-        to_tensor_2d,
-        num_attention_heads * size_per_head,
-        activation=value_act,
-        name="value",
-        kernel_initializer=create_initializer(initializer_range))
-    
-    # `query_layer` = [B, N, F, H]
-    query_layer = transpose_for_scores(query_layer, batch_size,
-                                     num_attention_heads, from_seq_length,
-                                     size_per_head)
-
-    # `key_layer` = [B, N, T, H]
-    key_layer = transpose_for_scores(key_layer, batch_size, num_attention_heads,
-                                   to_seq_length, size_per_head)
+    if (use_packed_qkv and from_tensor is to_tensor
+            and query_act is key_act is value_act):
+        # Self-attention: project Q, K and V with one packed [N*H, 3*N*H]
+        # matmul and split, instead of launching three separate GEMMs over
+        # the same input.
+        qkv_layer = tf.layers.dense(
+            from_tensor_2d,
+            3 * num_attention_heads * size_per_head,
+            activation=query_act,
+            name="qkv",
+            kernel_initializer=kernel_initializer)
+
+        # `query_layer`/`key_layer`/`value_layer` = [B*F, N*H]
+        query_layer, key_layer, value_layer = tf.split(qkv_layer, 3, axis=-1)
+    else:
+        # Cross-attention: Q comes from `from_tensor`, but K and V share
+        # `to_tensor`, so those two projections can pack into one GEMM when
+        # the caller opts in to the renamed "kv" variable.
+        # `query_layer` = [B*F, N*H]
+        query_layer = tf.layers.dense(
+            from_tensor_2d,
+            num_attention_heads * size_per_head,
+            activation=query_act,
+            name="query",
+            kernel_initializer=kernel_initializer)
+
+        if use_packed_qkv and key_act is value_act:
+            kv_layer = tf.layers.dense(
+                to_tensor_2d,
+                2 * num_attention_heads * size_per_head,
+                activation=key_act,
+                name="kv",
+                kernel_initializer=kernel_initializer)
+
+            # `key_layer`/`value_layer` = [B*T, N*H]
+            key_layer, value_layer = tf.split(kv_layer, 2, axis=-1)
+        else:
+            # `key_layer` = [B*T, N*H]
+            key_layer = tf.layers.dense(
+                to_tensor_2d,
+                num_attention_heads * size_per_head,
+                activation=key_act,
+                name="key",
+                kernel_initializer=kernel_initializer)
+
+            # `value_layer` = [B*T, N*H]
+            value_layer = tf.layers.dense(
+                to_tensor_2d,
+                num_attention_heads * size_per_head,
+                activation=value_act,
+                name="value",
+                kernel_initializer=kernel_initializer)
+
+
+    # Fold the 1/sqrt(H) attention scale into the query while it is still
+    # [B*F, N*H]; scaling here touches N*H values per position instead of
+    # rescaling the full [B, N, F, T] score tensor after the matmul.
+    query_layer = query_layer * (1.0 / math.sqrt(float(size_per_head)))
+
+    # `query_layer` = [B, F, N, H]
+    query_layer = tf.reshape(
+        query_layer,
+        [batch_size, from_seq_length, num_attention_heads, size_per_head])
+
+    # `key_layer` = [B, T, N, H]
+    key_layer = tf.reshape(
+        key_layer,
+        [batch_size, to_seq_length, num_attention_heads, size_per_head])
 
     # Take the dot product between "query" and "key" to get the raw
-    # attention scores.
+    # attention scores. The einsum contracts over H directly from the
+    # [B, S, N, H] layout, so no transpose kernels run before the matmul.
     # `attention_scores` = [B, N, F, T]
-    attention_scores = tf.matmul(query_layer, key_layer, transpose_b=True)
-    #attention_scores = tf.multiply(attention_scores, 1.0 / math.sqrt(float(size_per_head)))
-    
-    ''' distance ajusted attention mechanism '''
-    dist_array = np.arange(from_seq_length)
-    dist_attn = np.zeros((from_seq_length, from_seq_length))
-    for index in range(dist_attn.shape[0]):
-        dist_attn[index] = (dist_array-index)
-    marg_dist = (np.tril(dist_attn, 0)*-1) + (np.triu(dist_attn, 0)*1)
-    marg_dist = tf.cast(marg_dist, tf.float32)
-    marg_dist = (0.5 - tf.nn.softmax(marg_dist))
-    marg_dist = tf.multiply(tf.cast(attention_mask, tf.float32), marg_dist)
-    marg_dist = tf.expand_dims(marg_dist, axis=[1])
-    attention_scores = (attention_scores + marg_dist)
+    if use_bfloat16:
+        # bf16 inputs keep the matmul on the fast units; the scores come
+        # back to fp32 before the bias adds and softmax.
+        query_layer = tf.cast(query_layer, tf.bfloat16)
+        key_layer = tf.cast(key_layer, tf.bfloat16)
+        attention_scores = tf.cast(
+            tf.einsum("bfnh,btnh->bnft", query_layer, key_layer), tf.float32)
+    else:
+        attention_scores = tf.einsum("bfnh,btnh->bnft", query_layer, key_layer)
+    ''' distance ajusted attention mechanism (precomputed and pre-scaled by
+        1/sqrt(H) in transformer_model, so adding it to the already scaled
+        scores reproduces the original (scores + bias) * scale exactly) '''
+    if dist_bias is not None:
+        attention_scores = (attention_scores + dist_bias)
 
-    
-    attention_scores = tf.multiply(attention_scores, 1.0 / math.sqrt(float(size_per_head)))
-    
     #attention_scores = tf.linalg.band_part(attention_scores,0, -1)
     
-    if attention_mask is not None:
+    if attention_adder is None and attention_mask is not None:
         # `attention_mask` = [B, 1, F, T]
-        attention_mask = tf.expand_dims(attention_mask, axis=[1])        
+        attention_mask = tf.expand_dims(attention_mask, axis=[1])
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
         # positions we want to attend and -10000.0 for masked positions.
-        
-        adder = (1.0 - tf.cast(attention_mask, tf.float32)) * -10000.0
+
+        attention_adder = (1.0 - tf.cast(attention_mask, tf.float32)) * -10000.0
         #adder = (tf.cast(attention_mask, tf.float32) - 1.0) * -10000.0
         #adder = (1.0 - tf.cast(attention_mask, tf.float32))
-        
+
         #adder = adder+marg_dist
 
+    if attention_adder is not None:
         # Since we are adding it to the raw scores before the softmax, this is
         # effectively the same as removing these entirely.
-        attention_scores += adder
+        attention_scores += attention_adder
         
         #Second attention to normalize the scores over entities
         #sub_attention_mask = tf.expand_dims(sub_attention_mask, axis=[1])
@@ -1118,21 +1751,26 @@ def attention_layer(from_tensor,
 
     # This is actually dropping out entire tokens to attend to, which might
     # seem a bit unusual, but is taken from the original Transformer paper.
-    attention_probs = dropout(attention_probs, attention_probs_dropout_prob)
+    # BertModel zeroes the probability at inference, so no dropout node is
+    # ever built there; the guard makes that explicit at the call site.
+    if attention_probs_dropout_prob > 0.0:
+        attention_probs = dropout(attention_probs, attention_probs_dropout_prob)
 
     # `value_layer` = [B, T, N, H]
     value_layer = tf.reshape(
         value_layer,
         [batch_size, to_seq_length, num_attention_heads, size_per_head])
 
-    # `value_layer` = [B, N, T, H]
-    value_layer = tf.transpose(value_layer, [0, 2, 1, 3])
-
-    # `context_layer` = [B, N, F, H]
-    context_layer = tf.matmul(attention_probs, value_layer)
-
-    # `context_layer` = [B, F, N, H]
-    context_layer = tf.transpose(context_layer, [0, 2, 1, 3])
+    # `context_layer` = [B, F, N, H]; the einsum lands the output directly
+    # in the layout the final reshape wants, so the two transposes around
+    # the value matmul disappear.
+    if use_bfloat16:
+        context_layer = tf.cast(
+            tf.einsum("bnft,btnh->bfnh", tf.cast(attention_probs, tf.bfloat16),
+                      tf.cast(value_layer, tf.bfloat16)), tf.float32)
+    else:
+        context_layer = tf.einsum("bnft,btnh->bfnh", attention_probs,
+                                  value_layer)
 
     if do_return_2d_tensor:
         # `context_layer` = [B*F, N*H]
@@ -1151,6 +1789,7 @@ def attention_layer(from_tensor,
 
 def transformer_model(input_tensor,
                       attention_mask=None,
+                      input_mask=None,
                       sub_attention_mask=None,
                       hidden_size=768,
                       num_hidden_layers=12,
@@ -1160,7 +1799,11 @@ def transformer_model(input_tensor,
                       hidden_dropout_prob=0.1,
                       attention_probs_dropout_prob=0.1,
                       initializer_range=0.02,
-                      do_return_all_layers=False):
+                      do_return_all_layers=False,
+                      use_xla_jit=False,
+                      use_bfloat16=False,
+                      use_packed_qkv=False,
+                      use_fused_gelu=False):
     
     """Multi-headed, multi-layer Transformer from "Attention is All You Need".
 
@@ -1174,9 +1817,16 @@ def transformer_model(input_tensor,
     
       Args:
         input_tensor: float Tensor of shape [batch_size, seq_length, hidden_size].
-        attention_mask: (optional) int32 Tensor of shape [batch_size, seq_length,
-          seq_length], with 1 for positions that can be attended to and 0 in
-          positions that should not be.
+        attention_mask: (optional) int8/int32 Tensor of shape [batch_size,
+          seq_length, seq_length], with 1 for positions that can be attended
+          to and 0 in positions that should not be. Cast to float exactly
+          once here, so a narrow int8 mask costs a quarter of the memory
+          traffic between layers.
+        input_mask: (optional) int32 Tensor of shape [batch_size, seq_length]
+          with 1 for real tokens and 0 for padding. Preferred over
+          `attention_mask`: only the key axis needs masking, so this 2D form
+          broadcasts as [batch_size, 1, 1, seq_length] against the scores
+          without materializing the 3D outer-product mask.
         hidden_size: int. Hidden size of the Transformer.
         num_hidden_layers: int. Number of layers (blocks) in the Transformer.
         num_attention_heads: int. Number of attention heads in the Transformer.
@@ -1191,6 +1841,20 @@ def transformer_model(input_tensor,
           normal).
         do_return_all_layers: Whether to also return all layers or just the final
           layer.
+        use_xla_jit: Whether to compile each encoder block with XLA, fusing
+          the pointwise chains (bias add, gelu, dropout, residual add, layer
+          norm) between the matmuls into a handful of kernels.
+        use_bfloat16: Whether to run the attention matmuls in bfloat16;
+          see `attention_layer`.
+        use_packed_qkv: Whether to pack the attention projections into one
+          dense layer; renames the projection variables, so it is off by
+          default to keep existing checkpoints loadable. See
+          `attention_layer`.
+        use_fused_gelu: Whether to use the oneDNN fused
+          MatMul+BiasAdd+GELU kernel for the intermediate layer. Inference
+          only (the fused op has no gradient) and switches the activation
+          to the tanh approximation, so it is off by default; the default
+          path applies the configured activation exactly.
     
       Returns:
         float Tensor of shape [batch_size, seq_length, hidden_size], the final
@@ -1222,66 +1886,123 @@ def transformer_model(input_tensor,
     # help the optimizer.
     prev_output = reshape_to_matrix(input_tensor)
 
+    ''' distance ajusted attention mechanism. The bias depends only on the
+        sequence length and the attention mask, so it is built once here and
+        shared by every layer instead of being rebuilt num_hidden_layers
+        times inside attention_layer. '''
+    if isinstance(seq_length, int):
+        # softmax over a static matrix is itself static, so the entire
+        # 0.5 - softmax(|i-j|) bias folds to one cached constant.
+        marg_dist = tf.constant(dist_bias_matrix(seq_length),
+                                dtype=tf.float32, name="dist_bias_const")
+    else:
+        position_index = tf.range(seq_length)
+        marg_dist = tf.cast(tf.abs(position_index[None, :] - position_index[:, None]),
+                            tf.float32)
+        marg_dist = (0.5 - tf.nn.softmax(marg_dist))
+    # Pre-scale the bias by 1/sqrt(H): attention_layer folds the same scale
+    # into the query, so (scores + bias) * scale is preserved exactly while
+    # the per-layer full-score multiply disappears. For static lengths this
+    # folds into the constant above.
+    marg_dist = marg_dist * (1.0 / math.sqrt(float(attention_head_size)))
+    # Cast the mask to float once here; every layer previously repeated the
+    # cast and the adder multiply on the full [B, F, T] tensor.
+    if input_mask is not None:
+        # `input_mask_f` = [B, 1, T]; padding keys are knocked out by the
+        # broadcast, and padding query rows simply carry a softmax over the
+        # valid keys -- their outputs are never read downstream.
+        input_mask_f = tf.cast(
+            tf.reshape(input_mask, [batch_size, 1, seq_length]), tf.float32)
+        marg_dist = tf.multiply(input_mask_f, marg_dist)
+        # `attention_adder` = [B, 1, 1, T]; the broadcast add folds into
+        # the softmax input instead of launching over a full [B, N, F, T]
+        # materialized mask.
+        attention_adder = tf.expand_dims((1.0 - input_mask_f) * -10000.0,
+                                         axis=[1])
+    elif attention_mask is not None:
+        attention_mask_f = tf.cast(attention_mask, tf.float32)
+        marg_dist = tf.multiply(attention_mask_f, marg_dist)
+        # `attention_adder` = [B, 1, F, T]
+        attention_adder = tf.expand_dims((1.0 - attention_mask_f) * -10000.0,
+                                         axis=[1])
+    else:
+        attention_adder = None
+        # With no mask the bias is still rank 2 [F, T]; give it explicit
+        # batch and head axes so it broadcasts against the [B, N, F, T]
+        # scores instead of mis-aligning as [1, F, 1, T].
+        marg_dist = marg_dist[None, :, :]
+    # `dist_bias` = [B, 1, F, T] (or [1, 1, F, T] unmasked)
+    dist_bias = tf.expand_dims(marg_dist, axis=[1])
+
+    # One initializer object shared by every dense call below; each
+    # create_initializer call otherwise allocates a fresh closure per layer
+    # during graph build.
+    kernel_initializer = create_initializer(initializer_range)
+
     all_layer_outputs = []
     for layer_idx in range(num_hidden_layers):
-        with tf.variable_scope("layer_%d" % layer_idx):
+        with tf.variable_scope("layer_%d" % layer_idx), jit_scope(use_xla_jit):
             layer_input = prev_output
 
             with tf.variable_scope("attention"):
-                attention_heads = []
                 with tf.variable_scope("self"):
                     
-                    attention_head = attention_layer(
+                    attention_output = attention_layer(
                         from_tensor=layer_input,
                         to_tensor=layer_input,
                         attention_mask=attention_mask,
                         sub_attention_mask=sub_attention_mask,
+                        dist_bias=dist_bias,
+                        attention_adder=attention_adder,
+                        use_bfloat16=use_bfloat16,
+                        use_packed_qkv=use_packed_qkv,
                         num_attention_heads=num_attention_heads,
                         size_per_head=attention_head_size,
                         attention_probs_dropout_prob=attention_probs_dropout_prob,
                         initializer_range=initializer_range,
+                        kernel_initializer=kernel_initializer,
                         do_return_2d_tensor=True,
                         batch_size=batch_size,
                         from_seq_length=seq_length,
                         to_seq_length=seq_length)
-                
-                attention_heads.append(attention_head)
-
-                attention_output = None
-                if len(attention_heads) == 1:
-                    attention_output = attention_heads[0]
-                else:
-                    # In the case where we have other sequences, we just concatenate
-                    # them to the self-attention head before the projection.
-                    attention_output = tf.concat(attention_heads, axis=-1)
-        
-                    #print('Attention output:',attention_output)
                     # Run a linear projection of `hidden_size` then add a residual
                     # with `layer_input`.
                 with tf.variable_scope("output"):
                     attention_output = tf.layers.dense(
                         attention_output,
                         hidden_size,
-                        kernel_initializer=create_initializer(initializer_range))
-                    attention_output = dropout(attention_output, hidden_dropout_prob)
-                    attention_output = layer_norm(attention_output + layer_input)
+                        kernel_initializer=kernel_initializer)
+                    if hidden_dropout_prob > 0.0:
+                        attention_output = dropout(attention_output,
+                                                   hidden_dropout_prob)
+                    attention_output = add_layer_norm(
+                        attention_output, layer_input, use_xla_jit=use_xla_jit)
 
             # The activation is only applied to the "intermediate" hidden layer.
             with tf.variable_scope("intermediate"):
-                intermediate_output = tf.layers.dense(
-                    attention_output,
-                    intermediate_size,
-                    activation=intermediate_act_fn,
-                    kernel_initializer=create_initializer(initializer_range))
+                if use_fused_gelu and intermediate_act_fn in (gelu, gelu_approx):
+                    intermediate_output = fused_dense_gelu(
+                        attention_output,
+                        intermediate_size,
+                        initializer_range,
+                        name="dense")
+                else:
+                    intermediate_output = tf.layers.dense(
+                        attention_output,
+                        intermediate_size,
+                        activation=intermediate_act_fn,
+                        kernel_initializer=kernel_initializer)
 
             # Down-project back to `hidden_size` then add the residual.
             with tf.variable_scope("output"):
                 layer_output = tf.layers.dense(
                     intermediate_output,
                     hidden_size,
-                    kernel_initializer=create_initializer(initializer_range))
-                layer_output = dropout(layer_output, hidden_dropout_prob)
-                layer_output = layer_norm(layer_output + attention_output)
+                    kernel_initializer=kernel_initializer)
+                if hidden_dropout_prob > 0.0:
+                    layer_output = dropout(layer_output, hidden_dropout_prob)
+                layer_output = add_layer_norm(
+                    layer_output, attention_output, use_xla_jit=use_xla_jit)
                 prev_output = layer_output
                 all_layer_outputs.append(layer_output)
     
@@ -1311,14 +2032,19 @@ def get_shape_list(tensor, expected_rank=None, name=None):
         A list of dimensions of the shape of tensor. All static dimensions will
         be returned as python integers, and dynamic dimensions will be returned
         as tf.Tensor scalars.
+
+        The resolved shape is memoized on the tensor itself, so the repeat
+        calls made by every encoder layer reuse the first result (and its
+        tf.shape op, when any dimension is dynamic) instead of rebuilding it.
       """
-      
-    if name is None:
-        name = tensor.name
 
     if expected_rank is not None:
         assert_rank(tensor, expected_rank, name)
 
+    cached_shape = getattr(tensor, "_lbert_shape_list", None)
+    if cached_shape is not None:
+        return list(cached_shape)
+
     shape = tensor.shape.as_list()
 
     non_static_indexes = []
@@ -1326,12 +2052,16 @@ def get_shape_list(tensor, expected_rank=None, name=None):
         if dim is None:
             non_static_indexes.append(index)
 
-    if not non_static_indexes:
-        return shape
+    if non_static_indexes:
+        dyn_shape = tf.shape(tensor)
+        for index in non_static_indexes:
+            shape[index] = dyn_shape[index]
 
-    dyn_shape = tf.shape(tensor)
-    for index in non_static_indexes:
-        shape[index] = dyn_shape[index]
+    try:
+        tensor._lbert_shape_list = tuple(shape)
+    except AttributeError:
+        # Some tensor-like objects reject new attributes; skip the cache.
+        pass
     return shape
 
 
@@ -1375,22 +2105,40 @@ def assert_rank(tensor, expected_rank, name=None):
     
       Raises:
         ValueError: If the expected shape doesn't match the actual shape.
+
+        A passing check is recorded on the tensor, so the same check made
+        again later (every layer re-validates its inputs) returns
+        immediately with no dict construction or name lookup.
     """
-    
-    if name is None:
-        name = tensor.name
 
-    expected_rank_dict = {}
     if isinstance(expected_rank, six.integer_types):
-        expected_rank_dict[expected_rank] = True
+        rank_key = expected_rank
     else:
-        for x in expected_rank:
-            expected_rank_dict[x] = True
+        rank_key = tuple(expected_rank)
+
+    checked_ranks = getattr(tensor, "_lbert_rank_checked", None)
+    if checked_ranks is not None and rank_key in checked_ranks:
+        return
 
     actual_rank = tensor.shape.ndims
-    if actual_rank not in expected_rank_dict:
+    if isinstance(rank_key, tuple):
+        rank_matches = actual_rank in rank_key
+    else:
+        rank_matches = actual_rank == rank_key
+
+    if not rank_matches:
+        if name is None:
+            name = tensor.name
         scope_name = tf.get_variable_scope().name
         raise ValueError(
             "For the tensor `%s` in scope `%s`, the actual rank "
             "`%d` (shape = %s) is not equal to the expected rank `%s`" %
             (name, scope_name, actual_rank, str(tensor.shape), str(expected_rank)))
+
+    try:
+        if checked_ranks is None:
+            checked_ranks = set()
+            tensor._lbert_rank_checked = checked_ranks
+        checked_ranks.add(rank_key)
+    except AttributeError:
+        pass